@@ -5,7 +5,10 @@ import time
 import json
 import base64
 import shutil
+import socket
 import hashlib
+import functools
+import threading
 import argparse
 import subprocess
 from urllib import request, parse
@@ -31,8 +34,16 @@ SRT = ".srt"
 ASS = ".ass"
 JSON = ".json"
 
+LEASE_DIR = ".lease"
+LEASE_EXT = ".lock"
+DONE_EXT = ".done"
+MANIFEST = "manifest.json"
+LEASE_HEARTBEAT = 30
+LEASE_EXPIRY = 120
+STREAM_POLL = 2
 
-def get_ffmpeg_call(source_path, ext):
+
+def get_ffmpeg_call(source_path, ext, fragmented=False):
     ffmpeg_call = [
         "nice",
         "ffmpeg",
@@ -45,10 +56,15 @@ def get_ffmpeg_call(source_path, ext):
         source_path,
     ]
     if ext == MP4:
+        # faststart rewrites the file at the end, fragments are append only
+        if fragmented:
+            movflags = "+frag_keyframe+empty_moov+default_base_moof"
+        else:
+            movflags = "+faststart"
         ffmpeg_call.extend(
             [
                 "-movflags",
-                "+faststart",
+                movflags,
                 "-pix_fmt",
                 "yuv420p",
                 "-crf",
@@ -214,7 +230,7 @@ def get_subtitle_track(source_path, ass_subs, vtt_subs):
     return []
 
 
-def process(source_dir, target_dir, filename, ext=MP4):
+def process(source_dir, target_dir, filename, ext=MP4, streamer=None):
     print(f"process({source_dir}/{filename})", flush=True)
     source_path = os.path.join(source_dir, filename)
     # ffmpeg rly hates single quotes in filter_complex stuff
@@ -254,12 +270,15 @@ def process(source_dir, target_dir, filename, ext=MP4):
                 break
 
     if not os.path.isfile(target_path):
-        ffmpeg_call = get_ffmpeg_call(source_path, ext)
+        ffmpeg_call = get_ffmpeg_call(source_path, ext, fragmented=bool(streamer))
         ffmpeg_call.extend(get_audio_track(source_path))
         ffmpeg_call.extend(get_subtitle_track(source_path, ass_subs, vtt_subs))
         ffmpeg_call.append(target_path)
         print(" ".join(ffmpeg_call), flush=True)
-        subprocess.run(ffmpeg_call)
+        if streamer:
+            streamer(ffmpeg_call, target_path)
+        else:
+            subprocess.run(ffmpeg_call)
 
     if not vtt_subs:
         vtt_sub_path = None
@@ -364,6 +383,7 @@ class BackblazeUploader:
 
     def __init__(self) -> None:
         self.count = 0
+        self.streamed = {}
         # b2 auth
         with open("./backblaze_args", "r") as fn:
             backblaze_args = json.load(fn)
@@ -401,8 +421,10 @@ class BackblazeUploader:
         else:
             return f"video/{ext[1:]}"
 
-    def _filename(self, prefix, _basename, ext):
-        return f"{prefix}/{ext[1]}/{self.count:02}{ext}"
+    def _filename(self, prefix, _basename, ext, count=None):
+        if count is None:
+            count = self.count
+        return f"{prefix}/{ext[1]}/{count:02}{ext}"
 
     def _fileurl(self, filename):
         return (
@@ -426,9 +448,18 @@ class BackblazeUploader:
         upload_result = self._send_req(req)
         return self._fileurl(upload_result["fileName"])
 
-    def _upload_large_file(self, path, prefix):
-        basename, ext = os.path.splitext(os.path.basename(path))
-        filename = self._filename(prefix, basename, ext)
+    @staticmethod
+    def _upload_part(upload_url, upload_token, part_number, chunk):
+        req = request.Request(upload_url, data=chunk)
+        req.add_header("Authorization", upload_token)
+        req.add_header("Content-Length", len(chunk))
+        req.add_header("X-Bz-Part-Number", part_number)
+        chunk_sha1 = hashlib.sha1(chunk).hexdigest()
+        req.add_header("X-Bz-Content-Sha1", chunk_sha1)
+        BackblazeUploader._send_req(req)
+        return chunk_sha1
+
+    def _start_large_file(self, filename, ext):
         # b2_start_large_file
         start_info = self._send_api_req(
             "b2_start_large_file",
@@ -439,7 +470,17 @@ class BackblazeUploader:
             },
         )
         print(f"Upload {filename}")
-        file_id = start_info["fileId"]
+        return start_info["fileId"]
+
+    def _cancel_large_file(self, file_id, part_number):
+        # b2_cancel_large_file
+        cancel_info = self._send_api_req("b2_cancel_large_file", {"fileId": file_id})
+        print(f"\nCanceled {cancel_info['fileName']} after part {part_number}")
+
+    def _upload_large_file(self, path, prefix):
+        basename, ext = os.path.splitext(os.path.basename(path))
+        filename = self._filename(prefix, basename, ext)
+        file_id = self._start_large_file(filename, ext)
         part_number = 0
         try:
             # b2_get_upload_part_url (for each thread that are are uploading)
@@ -459,14 +500,9 @@ class BackblazeUploader:
                     if not chunk:
                         break
                     print(f" {part_number}/{part_count}", end="", flush=True)
-                    req = request.Request(upload_url, data=chunk)
-                    req.add_header("Authorization", upload_token)
-                    req.add_header("Content-Length", len(chunk))
-                    req.add_header("X-Bz-Part-Number", part_number)
-                    chunk_sha1 = hashlib.sha1(chunk).hexdigest()
-                    all_sha1.append(chunk_sha1)
-                    req.add_header("X-Bz-Content-Sha1", chunk_sha1)
-                    self._send_req(req)
+                    all_sha1.append(
+                        self._upload_part(upload_url, upload_token, part_number, chunk)
+                    )
                     part_number += 1
                     time.sleep(1)
             # b2_finish_large_file
@@ -477,16 +513,104 @@ class BackblazeUploader:
             print()
             return self._fileurl(upload_result["fileName"])
         except Exception as err:
-            # b2_cancel_large_file
-            cancel_info = self._send_api_req(
-                "b2_cancel_large_file", {"fileId": file_id}
-            )
-            print(f"\nCanceled {cancel_info['fileName']} after part {part_number}")
+            self._cancel_large_file(file_id, part_number)
             raise err
 
+    def encode_stream(self, ffmpeg_call, target_path, prefix):
+        """Run ffmpeg and upload its fragmented mp4 output while it grows"""
+        basename, ext = os.path.splitext(os.path.basename(target_path))
+        # name it as put() will, count is only bumped there
+        filename = self._filename(prefix, basename, ext, count=self.count + 1)
+        file_id = self._start_large_file(filename, ext)
+        encoder = None
+        part_number = 0
+        fn = None
+        try:
+            encoder = subprocess.Popen(ffmpeg_call)
+            # b2_get_upload_part_url (for each thread that are are uploading)
+            upload_part_url = self._send_api_req(
+                f"b2_get_upload_part_url?fileId={file_id}",
+            )
+            upload_url = upload_part_url["uploadUrl"]
+            upload_token = upload_part_url["authorizationToken"]
+            # b2_upload_part as soon as a full part is on disk
+            part_number = 1
+            all_sha1 = []
+            stream_sha1 = hashlib.sha1()
+            print("Part:", end="")
+            while True:
+                encoding = encoder.poll() is None
+                if fn is None and os.path.isfile(target_path):
+                    fn = open(target_path, "rb", buffering=0)
+                while fn is not None:
+                    available = os.fstat(fn.fileno()).st_size - fn.tell()
+                    # only the final part may be smaller than the minimum
+                    if available <= 0 or (encoding and available < self.min_part_size):
+                        break
+                    chunk = fn.read(self.min_part_size)
+                    print(f" {part_number}", end="", flush=True)
+                    all_sha1.append(
+                        self._upload_part(upload_url, upload_token, part_number, chunk)
+                    )
+                    stream_sha1.update(chunk)
+                    part_number += 1
+                if not encoding:
+                    break
+                time.sleep(STREAM_POLL)
+            print()
+            # None tells put() there is nothing worth uploading
+            if encoder.returncode != 0:
+                print(f"ffmpeg failed for {filename}")
+                self.streamed[target_path] = None
+                self._cancel_large_file(file_id, part_number)
+                return
+            # finishing makes the object live, so check it plays first
+            if ffprobe_duration(target_path) is None:
+                print(f"ffprobe failed for {filename}")
+                self.streamed[target_path] = None
+                self._cancel_large_file(file_id, part_number)
+                return
+            if len(all_sha1) < 2:
+                # too small for a large file, put() uploads it whole
+                self._cancel_large_file(file_id, part_number)
+                return
+            with open(target_path, "rb", buffering=0) as local_fn:
+                local_sha1 = hashlib.file_digest(local_fn, hashlib.sha1).hexdigest()
+            if local_sha1 != stream_sha1.hexdigest():
+                # ffmpeg went back and rewrote bytes that were already sent
+                print(f"SHA1 mismatch for {filename}")
+                self._cancel_large_file(file_id, part_number)
+                return
+            # b2_finish_large_file
+            upload_result = self._send_api_req(
+                "b2_finish_large_file",
+                {"fileId": file_id, "partSha1Array": all_sha1},
+            )
+            self.streamed[target_path] = self._fileurl(upload_result["fileName"])
+        except Exception as err:
+            # put() uploads the finished local file instead
+            print(f"\nStreaming {filename} failed: {err!r}")
+            try:
+                self._cancel_large_file(file_id, part_number)
+            except Exception as cancel_err:
+                # an unfinished large file only holds storage, keep the batch going
+                print(f"Cancel {filename} failed: {cancel_err!r}")
+            if encoder is None:
+                raise err
+            encoder.wait()
+        finally:
+            if fn is not None:
+                fn.close()
+
     def put(self, target_path, vtt_sub_path, prefix):
         self.count += 1
-        target_url = self._upload(target_path, prefix)
+        if target_path in self.streamed:
+            target_url = self.streamed.pop(target_path)
+            if target_url is None:
+                print(f"Skip {target_path}, encode failed")
+                return None
+        else:
+            target_url = self._upload(target_path, prefix)
         vtt_sub_url = None
         if vtt_sub_path:
             vtt_sub_url = self._upload(vtt_sub_path, prefix)
@@ -633,28 +757,264 @@ class DebugUploader:
         return metadata_path
 
 
-def local_process(ipath, upt, opath, ext):
+class Lease:
+    """Lock file claiming one source file, kept fresh by a heartbeat thread"""
+
+    def __init__(self, lease_dir, key, node) -> None:
+        self.path = os.path.join(lease_dir, key + LEASE_EXT)
+        self.clock_path = os.path.join(lease_dir, f".clock.{node}")
+        self.node = node
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _create(self):
+        try:
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w") as fn:
+            json.dump({"node": self.node, "time": time.time()}, fn)
+        return True
+
+    def _owner(self):
+        try:
+            with open(self.path, "r") as fn:
+                return json.load(fn).get("node")
+        except (OSError, ValueError):
+            return None
+
+    def _now(self):
+        # lease mtimes come from the share's clock, so read the time off it too
+        with open(self.clock_path, "w"):
+            pass
+        now = os.stat(self.clock_path).st_mtime
+        os.remove(self.clock_path)
+        return now
+
+    def _break_stale(self):
+        try:
+            age = self._now() - os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            return True
+        if age < LEASE_EXPIRY:
+            return False
+        # rename is atomic, only one node gets to break a given lease
+        stale_path = f"{self.path}.{self.node}"
+        try:
+            os.rename(self.path, stale_path)
+        except FileNotFoundError:
+            return False
+        if self._now() - os.stat(stale_path).st_mtime < LEASE_EXPIRY:
+            # renewed or retaken between the stat and the rename, put it back
+            try:
+                os.link(stale_path, self.path)
+            except FileExistsError:
+                pass
+            os.remove(stale_path)
+            return False
+        os.remove(stale_path)
+        print(f"Expired lease {self.path}", flush=True)
+        return True
+
+    def _heartbeat(self):
+        while not self._stop.wait(LEASE_HEARTBEAT):
+            owner = self._owner()
+            if owner is None:
+                # mid rename by another node or a hiccup on the share, retry
+                continue
+            if owner != self.node:
+                print(f"Lost lease {self.path}", flush=True)
+                self.lost = True
+                return
+            try:
+                os.utime(self.path)
+            except OSError:
+                pass
+
+    def held(self):
+        for _ in range(3):
+            if self.lost:
+                return False
+            owner = self._owner()
+            if owner is not None:
+                self.lost = owner != self.node
+                return not self.lost
+            time.sleep(1)
+        return False
+
+    def acquire(self):
+        if not self._create():
+            if not self._break_stale() or not self._create():
+                return False
+        self._thread = threading.Thread(target=self._heartbeat, daemon=True)
+        self._thread.start()
+        return True
+
+    def release(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._owner() == self.node:
+            os.remove(self.path)
+
+
+def source_files(ipath):
+    # keyed by name without single quotes, since process() renames those away
+    sources = {}
+    for filename in os.listdir(ipath):
+        if not filename.endswith(MKV) and not filename.endswith(MP4):
+            continue
+        sources[filename.replace("'", "")] = filename
+    return sources
+
+
+def write_json(path, data):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as fn:
+        json.dump(data, fn)
+    os.replace(tmp_path, path)
+
+
+def read_manifest(ipath, lease_dir, node):
+    # first node to start fixes the file list and numbering for everyone
+    manifest_path = os.path.join(lease_dir, MANIFEST)
+    try:
+        os.close(os.open(manifest_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        pass
+    else:
+        write_json(manifest_path, {"keys": sorted(source_files(ipath)), "node": node})
+    while True:
+        try:
+            with open(manifest_path, "r") as fn:
+                return json.load(fn)["keys"]
+        except ValueError:
+            # still empty, the creating node has not written it yet
+            time.sleep(1)
+
+
+def discard_output(ipath, opath, key, ext):
+    # no .done means any output here is from an interrupted run
+    basename = os.path.splitext(key)[0]
+    stale_paths = [os.path.join(opath, basename + ext)]
+    # vtt converted from an srt is regenerated by process()
+    if any(
+        name.startswith(basename) and name.endswith(SRT) for name in os.listdir(ipath)
+    ):
+        stale_paths.append(os.path.join(opath, basename + VTT))
+    for stale_path in stale_paths:
+        try:
+            os.remove(stale_path)
+        except FileNotFoundError:
+            pass
+
+
+def get_uploader(upt, stream):
+    if upt == "scp":
+        return SCPUploader()
+    elif upt == "b2" and stream:
+        return BackblazeUploader()
+    elif upt == "b2":
+        return B2SyncUploader()
+    else:
+        return DebugUploader()
+
+
+def distributed_process(ipath, upt, opath, ext, stream=False):
     if not opath:
         opath = os.path.join(ipath, ".out")
-    uploaded = []
     prefix = os.path.basename(ipath.strip("/"))
+    lease_dir = os.path.join(opath, LEASE_DIR)
+    os.makedirs(lease_dir, exist_ok=True)
+    node = f"{socket.gethostname()}-{os.getpid()}"
 
-    if upt == "scp":
-        uploader = SCPUploader()
-    elif upt == "b2":
-        uploader = B2SyncUploader()
+    if upt == "b2" and not stream:
+        # b2 sync --delete would wipe files uploaded by the other nodes
+        uploader = B2Uploader()
     else:
-        uploader = DebugUploader()
+        uploader = get_uploader(upt, stream)
+    streamer = None
+    if stream:
+        streamer = functools.partial(uploader.encode_stream, prefix=prefix)
+
+    keys = read_manifest(ipath, lease_dir, node)
+    while True:
+        pending = [
+            key
+            for key in keys
+            if not os.path.isfile(os.path.join(lease_dir, key + DONE_EXT))
+        ]
+        if not pending:
+            break
+        claimed = False
+        for key in pending:
+            done_path = os.path.join(lease_dir, key + DONE_EXT)
+            lease = Lease(lease_dir, key, node)
+            if not lease.acquire():
+                continue
+            claimed = True
+            try:
+                if os.path.isfile(done_path):
+                    continue
+                filename = source_files(ipath).get(key)
+                if filename is None:
+                    # removed from ipath after startup, nothing left to encode
+                    write_json(done_path, {"url": None, "node": node})
+                    continue
+                discard_output(ipath, opath, key, ext)
+                url = None
+                # remote names are numbered by position, not by claim order
+                uploader.count = keys.index(key)
+                result = process(ipath, opath, filename, ext=ext, streamer=streamer)
+                # another node took over, leave the file to it
+                if not lease.held():
+                    print(f"Abort {filename}, lease lost", flush=True)
+                    continue
+                if result:
+                    target_path, vtt_sub_path = result
+                    url = uploader.put(target_path, vtt_sub_path, prefix)
+                if not lease.held():
+                    print(f"Abort {filename}, lease lost", flush=True)
+                    continue
+                write_json(done_path, {"url": url, "node": node})
+            finally:
+                lease.release()
+        if not claimed:
+            time.sleep(LEASE_HEARTBEAT)
+
+    uploaded = []
+    for key in keys:
+        with open(os.path.join(lease_dir, key + DONE_EXT), "r") as fn:
+            url = json.load(fn).get("url")
+        if url:
+            uploaded.append(url)
+
+    print()
+    print(",".join(uploaded))
+
+
+def local_process(ipath, upt, opath, ext, stream=False):
+    if not opath:
+        opath = os.path.join(ipath, ".out")
+    uploaded = []
+    prefix = os.path.basename(ipath.strip("/"))
+
+    uploader = get_uploader(upt, stream)
+    streamer = None
+    if stream:
+        streamer = functools.partial(uploader.encode_stream, prefix=prefix)
 
     for filename in sorted(os.listdir(ipath)):
         if not filename.endswith(MKV) and not filename.endswith(MP4):
             continue
-        result = process(ipath, opath, filename, ext=ext)
+        result = process(ipath, opath, filename, ext=ext, streamer=streamer)
         if not result:
             continue
         target_path, vtt_sub_path = result
         url = uploader.put(target_path, vtt_sub_path, prefix)
-        uploaded.append(url)
+        if url:
+            uploaded.append(url)
 
     try:
         uploader.finalize()
@@ -690,10 +1050,25 @@ if __name__ == "__main__":
         choices=["up", "ls", "rm"],
         help="up: upload, ls: print json links, rm: remove",
     )
+    parser.add_argument(
+        "-dist",
+        action="store_true",
+        help="claim files with lease files in opath, for multiple hosts sharing ipath",
+    )
+    parser.add_argument(
+        "-stream",
+        action="store_true",
+        help="upload fragmented mp4 to b2 while encoding, requires -upt b2 -ext .mp4",
+    )
     args = parser.parse_args()
+    if args.stream and (args.upt != "b2" or args.ext != MP4):
+        parser.error("-stream requires -upt b2 and -ext .mp4")
 
     if args.upt == "b2" and args.opt != "up":
         b2_opt(args.ipath, args.opt)
         exit()
 
-    local_process(args.ipath, args.upt, args.opath, args.ext)
+    if args.dist:
+        distributed_process(args.ipath, args.upt, args.opath, args.ext, args.stream)
+    else:
+        local_process(args.ipath, args.upt, args.opath, args.ext, args.stream)